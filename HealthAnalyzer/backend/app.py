@@ -8,9 +8,16 @@ from flask_cors import CORS
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
-import json
+import hashlib
 
 import traceback
+from storage import UserDataStore, SCANS, ALTERNATIVES_REQUESTS, CHAT_HISTORY
+from chat_memory import ConversationMemory
+from compression import init_compression
+from model_routing import (
+    ModelRouter, ANALYZE_TIERS, ALTERNATIVES_TIERS, PERPLEXITY_URL,
+    validate_analysis, validate_alternatives, completion_content, perplexity_headers
+)
 load_dotenv(dotenv_path="env.example")
 
 # Configure logging
@@ -32,6 +39,7 @@ logger.addHandler(file_handler)
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
+init_compression(app)
 
 logger.info("Starting Health Analyzer backend")
 
@@ -41,6 +49,9 @@ firebase_admin.initialize_app(cred)
 db = firestore.client()
 logger.info("Firebase initialized successfully")
 
+# All per-user reads and writes go through the storage layer
+store = UserDataStore(db)
+
 # Firebase configuration
 firebase_config = {
     "apiKey": os.environ.get("FIREBASE_API_KEY"),
@@ -56,6 +67,48 @@ firebase_config = {
 perplexity_api_key = os.environ.get("PERPLEXITY_API_KEY")
 logger.info("Perplexity API key initialized")
 
+
+# Summaries run in the background, but should not hold a thread indefinitely
+SUMMARY_TIMEOUT = int(os.environ.get("CHAT_SUMMARY_TIMEOUT", 30))
+
+
+def summarize_conversation(previous_summary, turns, max_tokens):
+    """Fold older chat turns into the rolling session summary."""
+    transcript = "\n".join(
+        f"User: {turn['user']}\nMs. Labelly: {turn['assistant']}" for turn in turns
+    )
+    prompt = f"""Update the running summary of a conversation between a user and Ms. Labelly, a food and nutrition assistant.
+Keep facts about the user (allergies, diet, goals, products discussed) and any open questions. Be brief and write plain text only.
+
+Current summary:
+{previous_summary or "None"}
+
+New exchanges:
+{transcript}"""
+
+    response = requests.post(
+        PERPLEXITY_URL,
+        headers=perplexity_headers(perplexity_api_key),
+        json={
+            "model": "sonar",
+            "messages": [
+                {"role": "system", "content": "You summarize conversations accurately and concisely."},
+                {"role": "user", "content": prompt},
+            ],
+            "max_tokens": max_tokens,
+        },
+        timeout=SUMMARY_TIMEOUT,
+    )
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"].strip()
+
+
+# Cheap-first model routing for label analysis and alternatives
+model_router = ModelRouter(perplexity_api_key)
+
+# Bounded multi-turn memory for the chatbot
+chat_memory = ConversationMemory(store, summarize_conversation)
+
 @app.route("/", methods=["GET"])
 def health_check():
     logger.debug("Health check endpoint called")
@@ -100,13 +153,6 @@ def analyze_ingredients():
     image_data_uri = f"data:image/jpeg;base64,{base64_image}"
 
     # Prepare Perplexity API request
-    url = "https://api.perplexity.ai/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {perplexity_api_key}",
-        "accept": "application/json",
-        "content-type": "application/json",
-    }
-
     prompt = """
 You are an AI assistant that analyzes food product ingredient labels for health and safety. Given a list of ingredients, categorize them into the following:
 
@@ -138,6 +184,9 @@ Additionally:
 6. Include a "product_summary" field:
    - A single-sentence summary that briefly describes the nature and safety of the product.
 
+7. Include a "confidence" field:
+   - A number between 0 and 1 for how confident you are that the label was read completely and every ingredient was classified correctly.
+
 Use this exact JSON structure:
 
 {
@@ -187,7 +236,8 @@ Use this exact JSON structure:
     }
   },
   "allergen_additive_warnings": ["list of allergens or additives, or ['None']"],
-  "product_summary": "string - One sentence describing the product's general purpose and safety"
+  "product_summary": "string - One sentence describing the product's general purpose and safety",
+  "confidence": "number between 0 and 1 - confidence in the completeness and accuracy of this analysis"
 }
 
 Example response:
@@ -293,7 +343,8 @@ Example response:
     }
   },
   "allergen_additive_warnings": ["Milk", "Artificial Flavoring Substances", "Caramel Color"],
-  "product_summary": "A chocolate malt drink mix with mostly nutritious ingredients, though high in sugar and includes additives."
+  "product_summary": "A chocolate malt drink mix with mostly nutritious ingredients, though high in sugar and includes additives.",
+  "confidence": 0.9
 }
 """
 
@@ -301,8 +352,8 @@ Example response:
 
 
     
+    # Model and search context are chosen per tier by the router
     payload = {
-        "model": "sonar-pro",
         "messages": [
             {"role": "system", "content": "Be precise and concise."},
             {
@@ -313,16 +364,13 @@ Example response:
                 ],
             },
         ],
-        "web_search_options": {"search_context_size": "medium"},
     }
 
     try:
         logger.info("Calling Perplexity API")
-        # Call Perplexity API
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        perplexity_data = response.json()
-        logger.info("Perplexity API call successful")
+        # Call Perplexity API, escalating to a stronger tier if needed
+        perplexity_data, _, tier = model_router.complete("analyze", payload, ANALYZE_TIERS, validate_analysis)
+        logger.info(f"Perplexity API call successful ({tier['model']})")
 
         # Store scan in Firestore
         logger.info("Storing scan data in Firestore")
@@ -333,7 +381,7 @@ Example response:
         }
 
         # Insert scan data into Firestore
-        db.collection("scans").add(scan_data)
+        store.add(SCANS, user_id, scan_data)
         logger.info("Scan data stored successfully")
 
         # Return the analysis to the client
@@ -373,24 +421,47 @@ def get_user_scans():
         user_id = decoded_token["uid"]
         logger.info(f"User authenticated: {user_id}")
 
-        # Get user scans from Firestore
-        logger.info(f"Retrieving scans for user: {user_id}")
-        scans_ref = (
-            db.collection("scans")
-            .where("user_id", "==", user_id)
-            .order_by("timestamp", direction=firestore.Query.DESCENDING)
-        )
-        scans = scans_ref.stream()
+        # Derive cache validators from the latest scan before loading history
+        latest = store.query(SCANS, user_id, limit=1).get()
+        last_modified = latest[0].get("timestamp") if latest else None
+        version = f"{latest[0].id}:{last_modified.isoformat()}" if last_modified else "empty"
+        etag = hashlib.sha1(f"{user_id}:{version}".encode("utf-8")).hexdigest()
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = bool(
+                last_modified
+                and request.if_modified_since
+                and last_modified.replace(microsecond=0) <= request.if_modified_since
+            )
+
+        if not_modified:
+            logger.info(f"Scan history unchanged for user: {user_id}")
+            response = app.response_class(status=304)
+        else:
+            # Get user scans from Firestore
+            logger.info(f"Retrieving scans for user: {user_id}")
+            scans_ref = store.query(SCANS, user_id)
+            scans = scans_ref.stream()
+
+            # Convert to list of dictionaries
+            scans_data = []
+            for scan in scans:
+                scan_dict = scan.to_dict()
+                scan_dict["id"] = scan.id  # Add document ID
+                scans_data.append(scan_dict)
 
-        # Convert to list of dictionaries
-        scans_data = []
-        for scan in scans:
-            scan_dict = scan.to_dict()
-            scan_dict["id"] = scan.id  # Add document ID
-            scans_data.append(scan_dict)
+            logger.info(f"Retrieved {len(scans_data)} scans")
+            response = jsonify({"scans": scans_data})
 
-        logger.info(f"Retrieved {len(scans_data)} scans")
-        return jsonify({"scans": scans_data}), 200
+        # Clients may cache but must revalidate on every visit
+        response.set_etag(etag, weak=True)
+        if last_modified:
+            response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
 
     except Exception as e:
         logger.error(f"Error retrieving scans: {str(e)}")
@@ -429,13 +500,6 @@ def get_product_alternatives():
     logger.info(f"Processing alternatives request for product: {analysis_data.get('product_name', 'Unknown')}")
 
     # Prepare Perplexity API request for alternatives
-    url = "https://api.perplexity.ai/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {perplexity_api_key}",
-        "accept": "application/json",
-        "content-type": "application/json",
-    }
-
     prompt = f"""
 Based on the following product analysis, recommend 3-5 healthier alternatives that are available in the market. Focus on products that address the specific health concerns identified in the original product.
 
@@ -474,7 +538,8 @@ Use this exact JSON structure:
     "avoid_ingredients": ["list of ingredients to avoid when shopping"],
     "look_for_ingredients": ["list of ingredients to look for instead"],
     "shopping_tips": ["2-3 practical shopping tips"]
-  }}
+  }},
+  "confidence": "number between 0 and 1 - confidence that these alternatives are real, available and address the concerns"
 }}
 
 Example response:
@@ -518,66 +583,53 @@ Example response:
     "avoid_ingredients": ["High fructose corn syrup", "Artificial colors", "Excessive added sugar", "Preservatives like BHT/BHA"],
     "look_for_ingredients": ["Organic cocoa", "Natural sweeteners", "Real vanilla extract", "Minimal ingredient lists"],
     "shopping_tips": ["Read labels carefully", "Choose organic when possible", "Consider making drinks at home for better control"]
-  }}
+  }},
+  "confidence": 0.85
 }}
 
 Focus on realistic, widely available alternatives that specifically address the health concerns from the original product analysis. Include realistic search-friendly purchase links for major retailers.
 """
 
+    # Model and search context are chosen per tier by the router
     payload = {
-        "model": "sonar-pro", 
         "messages": [
             {"role": "system", "content": "You are a nutrition expert providing healthier product alternatives. Be practical and specific."},
             {"role": "user", "content": prompt}
         ],
-        "web_search_options": {"search_context_size": "high"},
     }
 
     try:
         logger.info("Calling Perplexity API for alternatives")
-        # Call Perplexity API
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        perplexity_data = response.json()
-        logger.info("Perplexity API call for alternatives successful")
+        # Call Perplexity API, escalating to a stronger tier if needed
+        perplexity_data, alternatives_data, tier = model_router.complete(
+            "alternatives", payload, ALTERNATIVES_TIERS, validate_alternatives
+        )
+        logger.info(f"Perplexity API call for alternatives successful ({tier['model']})")
 
-        # Extract the alternatives content
-        alternatives_content = perplexity_data.get("choices", [{}])[0].get("message", {}).get("content", "")
-        
-        # Parse the JSON response
-        try:
-            # Extract JSON from the response
-            json_match = alternatives_content.strip()
-            if json_match.startswith('```json'):
-                json_match = json_match[7:-3]  # Remove ```json and ```
-            elif json_match.startswith('```'):
-                json_match = json_match[3:-3]  # Remove ``` and ```
-            
-            alternatives_data = json.loads(json_match)
-            
-            # Store alternatives request in Firestore for future reference
-            logger.info("Storing alternatives data in Firestore")
-            alternatives_request_data = {
-                "user_id": user_id,
-                "original_product": analysis_data.get('product_name', 'Unknown'),
-                "alternatives_result": alternatives_data,
-                "original_analysis": analysis_data,
-                "timestamp": firestore.SERVER_TIMESTAMP,
-            }
-
-            db.collection("alternatives_requests").add(alternatives_request_data)
-            logger.info("Alternatives data stored successfully")
-
-            return jsonify({
-                "alternatives": alternatives_data,
-                "citations": perplexity_data.get("citations", [])
-            }), 200
-            
-        except json.JSONDecodeError as parse_error:
-            logger.error(f"Failed to parse alternatives JSON: {parse_error}")
+        if alternatives_data is None:
+            alternatives_content = completion_content(perplexity_data)
+            logger.error("Failed to parse alternatives JSON")
             logger.error(f"Raw content: {alternatives_content}")
             return jsonify({"error": "Failed to parse alternatives response"}), 500
 
+        # Store alternatives request in Firestore for future reference
+        logger.info("Storing alternatives data in Firestore")
+        alternatives_request_data = {
+            "user_id": user_id,
+            "original_product": analysis_data.get('product_name', 'Unknown'),
+            "alternatives_result": alternatives_data,
+            "original_analysis": analysis_data,
+            "timestamp": firestore.SERVER_TIMESTAMP,
+        }
+
+        store.add(ALTERNATIVES_REQUESTS, user_id, alternatives_request_data)
+        logger.info("Alternatives data stored successfully")
+
+        return jsonify({
+            "alternatives": alternatives_data,
+            "citations": perplexity_data.get("citations", [])
+        }), 200
+
     except Exception as e:
         logger.error(f"Alternatives error: {str(e)}")
         logger.error(traceback.format_exc())
@@ -613,13 +665,20 @@ def chatbot_query():
 
     user_message = data["message"]
     context_data = data.get("context", {})  # Optional context from previous scans
+    session_id = data.get("session_id") or chat_memory.new_session_id()
+    if not chat_memory.is_valid_session_id(session_id):
+        logger.warning("Invalid session_id provided in request")
+        return jsonify({"error": "Invalid session_id"}), 400
     
     logger.info(f"Processing chatbot query: {user_message[:100]}...")
 
+    # Load recent turns and rolling summary for this conversation
+    session = chat_memory.load(user_id, session_id)
+
     # Get user's recent scans for context (last 5 scans)
     user_scans_context = ""
     try:
-        scans_ref = db.collection("scans").where("user_id", "==", user_id).order_by("timestamp", direction=firestore.Query.DESCENDING).limit(5)
+        scans_ref = store.query(SCANS, user_id, limit=5)
         scans = scans_ref.get()
         
         if scans:
@@ -643,13 +702,6 @@ def chatbot_query():
         logger.warning(f"Could not fetch user scan history for context: {str(e)}")
 
     # Prepare Perplexity API request
-    url = "https://api.perplexity.ai/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {perplexity_api_key}",
-        "accept": "application/json",
-        "content-type": "application/json",
-    }
-
     # Enhanced system prompt for Ms. Labelly
     system_prompt = """You are Ms. Labelly, a friendly and knowledgeable health assistant specializing in food ingredients, nutrition, and wellness. You help users understand:
 
@@ -683,12 +735,11 @@ When users ask about ingredients or products, provide:
     # Construct the user prompt with context
     user_prompt = f"{user_message}{user_scans_context}"
 
+    messages, replayed_turns = chat_memory.build_messages(system_prompt, session, user_prompt)
+
     payload = {
         "model": "sonar",
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
+        "messages": messages,
         "web_search_options": {"search_context_size": "medium"},
         "max_tokens": 1000
     }
@@ -696,7 +747,7 @@ When users ask about ingredients or products, provide:
     try:
         logger.info("Calling Perplexity API for chatbot response")
         # Call Perplexity API
-        response = requests.post(url, headers=headers, json=payload)
+        response = requests.post(PERPLEXITY_URL, headers=perplexity_headers(perplexity_api_key), json=payload)
         response.raise_for_status()
         perplexity_data = response.json()
         logger.info("Perplexity API call for chatbot successful")
@@ -708,18 +759,22 @@ When users ask about ingredients or products, provide:
         logger.info("Storing chat interaction in Firestore")
         chat_data = {
             "user_id": user_id,
+            "session_id": session_id,
             "user_message": user_message,
             "bot_response": bot_response,
             "context_used": bool(user_scans_context),
             "timestamp": firestore.SERVER_TIMESTAMP,
         }
 
-        db.collection("chat_history").add(chat_data)
+        store.add(CHAT_HISTORY, user_id, chat_data)
         logger.info("Chat interaction stored successfully")
 
+        chat_memory.append(user_id, session_id, user_message, bot_response, replayed_turns)
+
         return jsonify({
             "response": bot_response,
-            "citations": perplexity_data.get("citations", [])
+            "citations": perplexity_data.get("citations", []),
+            "session_id": session_id
         }), 200
 
     except Exception as e:
@@ -0,0 +1,193 @@
+import os
+import re
+import uuid
+import logging
+import threading
+from firebase_admin import firestore
+
+from storage import CHAT_SESSIONS
+
+logger = logging.getLogger(__name__)
+
+# Rough chars-per-token ratio, good enough for budgeting English prompts
+CHARS_PER_TOKEN = 4
+
+# Session IDs become Firestore document IDs, so keep them short and path-safe
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+# Firestore reserves IDs of the form __...__
+RESERVED_ID_PATTERN = re.compile(r"__.*__")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_to_tokens(text, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(" ", 1)[0] + "..."
+
+
+class ConversationMemory:
+    """Bounded memory for multi-turn chatbot sessions.
+
+    Each session keeps its most recent turns verbatim and folds older turns
+    into a rolling summary, both stored in users/{uid}/chat_sessions/{session_id}.
+    The document is read once per request and turns are appended in a
+    transaction, so any worker can serve any turn. Summarizing runs in a
+    background thread after the reply is sent. Full transcripts still go to
+    chat_history.
+    """
+
+    def __init__(self, store, summarize_fn, recent_turns=None, compact_batch=None,
+                 token_budget=None, summary_tokens=None):
+        self.store = store
+        self.summarize_fn = summarize_fn
+        self.recent_turns = recent_turns or int(os.environ.get("CHAT_RECENT_TURNS", 6))
+        self.compact_batch = compact_batch or int(os.environ.get("CHAT_COMPACT_BATCH", 4))
+        self.token_budget = token_budget or int(os.environ.get("CHAT_CONTEXT_TOKEN_BUDGET", 3000))
+        self.summary_tokens = summary_tokens or int(os.environ.get("CHAT_SUMMARY_TOKENS", 300))
+        # If summarizing keeps failing, the oldest turns are dropped past this
+        # point so the session document stays small
+        self.max_turns = self.recent_turns + 3 * self.compact_batch
+        self.compacting = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def is_valid_session_id(session_id):
+        return (
+            isinstance(session_id, str)
+            and SESSION_ID_PATTERN.fullmatch(session_id) is not None
+            and RESERVED_ID_PATTERN.fullmatch(session_id) is None
+        )
+
+    def session_ref(self, user_id, session_id):
+        return self.store.user_document(CHAT_SESSIONS, user_id, session_id)
+
+    def load(self, user_id, session_id):
+        """Return the stored session state (one document read)."""
+        try:
+            doc = self.session_ref(user_id, session_id).get()
+            if doc.exists:
+                data = doc.to_dict()
+                return {"summary": data.get("summary", ""), "turns": data.get("turns", [])}
+        except Exception as e:
+            logger.warning(f"Could not load chat session {session_id}: {str(e)}")
+        return {"summary": "", "turns": []}
+
+    def build_messages(self, system_prompt, session, user_prompt):
+        """Assemble chat messages that fit within the token budget.
+
+        The system prompt, summary and current message are always included;
+        recent turns are added newest first until the budget runs out.
+        Returns (messages, replayed_turns) so append can compact the turns
+        that did not fit.
+        """
+        summary = truncate_to_tokens(session["summary"], self.summary_tokens)
+        if summary:
+            system_prompt = f"{system_prompt}\n\nSummary of the conversation so far:\n{summary}"
+
+        remaining = self.token_budget - estimate_tokens(system_prompt) - estimate_tokens(user_prompt)
+
+        history = []
+        for turn in reversed(session["turns"]):
+            cost = estimate_tokens(turn["user"]) + estimate_tokens(turn["assistant"])
+            if cost > remaining:
+                break
+            history[:0] = [
+                {"role": "user", "content": turn["user"]},
+                {"role": "assistant", "content": turn["assistant"]},
+            ]
+            remaining -= cost
+
+        logger.info(f"Chat context: {len(history) // 2}/{len(session['turns'])} turns, "
+                    f"summary={'yes' if summary else 'no'}, ~{self.token_budget - remaining} tokens")
+
+        messages = (
+            [{"role": "system", "content": system_prompt}]
+            + history
+            + [{"role": "user", "content": user_prompt}]
+        )
+        return messages, len(history) // 2
+
+    def append(self, user_id, session_id, user_message, bot_response, replayed_turns):
+        """Record a turn and schedule compaction once the window overflows.
+
+        Compaction runs when the window reaches recent_turns + compact_batch,
+        or as soon as it holds turns the last prompt could not replay, so no
+        turn is left out of both the prompt and the summary.
+        """
+        ref = self.session_ref(user_id, session_id)
+        turn = {"user": user_message, "assistant": bot_response}
+
+        @firestore.transactional
+        def add_turn(transaction):
+            snapshot = ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else {}
+            turns = data.get("turns", []) + [turn]
+            if len(turns) > self.max_turns:
+                # Dropped turns remain in chat_history; only the summary misses them
+                logger.warning(f"Dropping {len(turns) - self.max_turns} uncompacted turns from session {session_id}")
+                turns = turns[-self.max_turns:]
+            transaction.set(ref, {
+                "summary": data.get("summary", ""),
+                "turns": turns,
+                "updated_at": firestore.SERVER_TIMESTAMP,
+            })
+            return len(turns)
+
+        try:
+            turn_count = add_turn(self.store.db.transaction())
+        except Exception as e:
+            logger.error(f"Could not persist chat session {session_id}: {str(e)}")
+            return
+
+        # The turns just replayed plus the new one are all that fit the budget
+        keep = min(self.recent_turns, replayed_turns + 1)
+        over_count = turn_count >= self.recent_turns + self.compact_batch
+        over_budget = turn_count > replayed_turns + 1
+        if over_count or over_budget:
+            key = (user_id, session_id)
+            with self.lock:
+                if key in self.compacting:
+                    return
+                self.compacting.add(key)
+            threading.Thread(target=self.compact, args=(user_id, session_id, keep), daemon=True).start()
+
+    def compact(self, user_id, session_id, keep):
+        """Fold all but the newest keep turns into the summary."""
+        ref = self.session_ref(user_id, session_id)
+        try:
+            session = self.load(user_id, session_id)
+            overflow = session["turns"][:-keep]
+            if not overflow:
+                return
+
+            summary = self.summarize_fn(session["summary"], overflow, self.summary_tokens)
+
+            @firestore.transactional
+            def apply_summary(transaction):
+                snapshot = ref.get(transaction=transaction)
+                data = snapshot.to_dict() if snapshot.exists else {}
+                turns = data.get("turns", [])
+                # Skip if another worker compacted or trimmed these turns meanwhile
+                if data.get("summary", "") != session["summary"] or turns[:len(overflow)] != overflow:
+                    return False
+                transaction.update(ref, {"summary": summary, "turns": turns[len(overflow):]})
+                return True
+
+            if apply_summary(self.store.db.transaction()):
+                logger.info(f"Compacted {len(overflow)} turns into summary for session {session_id}")
+            else:
+                logger.info(f"Skipped stale compaction for session {session_id}")
+        except Exception as e:
+            # Turns stay in the window and compaction is retried on the next turn
+            logger.warning(f"Could not summarize chat session {session_id}: {str(e)}")
+        finally:
+            with self.lock:
+                self.compacting.discard((user_id, session_id))
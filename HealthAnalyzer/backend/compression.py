@@ -0,0 +1,69 @@
+import os
+import gzip
+import logging
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/plain", "text/html")
+
+# Favour speed over ratio: these are dynamic responses compressed per request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def choose_encoding(accept_encodings):
+    """Pick the best encoding the client accepts, preferring brotli."""
+    if brotli is not None and accept_encodings["br"] > 0:
+        return "br"
+    if accept_encodings["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+def init_compression(app, min_size=None):
+    """Compress API responses above min_size bytes with brotli or gzip."""
+    min_size = min_size or int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.status_code != 200
+            or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+
+        response.vary.add("Accept-Encoding")
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if encoding == "br":
+            compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+        else:
+            compressed = gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+
+        # The body bytes changed, so any strong validator no longer applies
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+        logger.debug(f"Compressed {request.path} with {encoding}: {len(data)} -> {len(compressed)} bytes")
+        return response
+
+    logger.info(f"Response compression enabled (min size {min_size} bytes, brotli {'on' if brotli else 'off'})")
@@ -0,0 +1,55 @@
+"""Copy top-level scans/alternatives_requests/chat_history documents into
+per-user subcollections (users/{uid}/<collection>).
+
+Run with the app in dual-write mode (the default), then switch reads over
+with STORAGE_READ_MODE=user once every collection has been copied:
+
+    python migrate_user_data.py
+    python migrate_user_data.py --collection scans --dry-run
+    python migrate_user_data.py --collection scans --start-after <doc id>
+"""
+import os
+import argparse
+import logging
+from dotenv import load_dotenv
+import firebase_admin
+from firebase_admin import credentials, firestore
+
+from storage import UserDataStore, USER_COLLECTIONS, MAX_BATCH_SIZE
+
+load_dotenv(dotenv_path="env.example")
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy user data into per-user subcollections")
+    parser.add_argument("--collection", choices=USER_COLLECTIONS, action="append",
+                        help="Collection to copy (repeatable, defaults to all)")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE,
+                        help=f"Documents per batched write (max {MAX_BATCH_SIZE})")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Count documents without writing anything")
+    parser.add_argument("--start-after",
+                        help="Resume cursor (document ID) logged by an interrupted run; needs one --collection")
+    args = parser.parse_args()
+
+    if args.start_after and len(args.collection or USER_COLLECTIONS) != 1:
+        parser.error("--start-after requires exactly one --collection")
+
+    service_account_path = os.environ.get("FIREBASE_SERVICE_ACCOUNT_PATH")
+    cred = credentials.Certificate(service_account_path)
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+
+    store = UserDataStore(db)
+    for name in args.collection or USER_COLLECTIONS:
+        logger.info(f"{'Counting' if args.dry_run else 'Copying'} {name}")
+        count = store.copy_to_user_layout(name, batch_size=args.batch_size, dry_run=args.dry_run,
+                                          start_after=args.start_after)
+        logger.info(f"{name}: {count} documents {'would be copied' if args.dry_run else 'copied'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import os
+import copy
+import re
+import json
+import time
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
+
+# Tiers are tried in order; the last one is the fallback whose result is
+# returned even if it fails validation. Timeouts are in seconds; the fast
+# tier's is short so a stuck call escalates instead of blocking the route.
+ANALYZE_TIERS = [
+    {"name": "fast", "model": "sonar", "search_context_size": "low", "timeout": 20},
+    {"name": "pro", "model": "sonar-pro", "search_context_size": "medium", "timeout": 90},
+]
+ALTERNATIVES_TIERS = [
+    {"name": "fast", "model": "sonar", "search_context_size": "medium", "timeout": 20},
+    {"name": "pro", "model": "sonar-pro", "search_context_size": "high", "timeout": 90},
+]
+
+CATEGORY_KEYS = ("safe", "low_risk", "not_great", "dangerous")
+ANALYSIS_KEYS = (
+    "product_name",
+    "safety_score",
+    "ingredients_summary",
+    "ingredient_categories",
+    "allergen_additive_warnings",
+    "product_summary",
+)
+ALTERNATIVE_KEYS = ("product_name", "brand", "why_better", "key_improvements")
+
+
+def parse_json_content(content):
+    """Parse the outermost {...} in a completion. Returns None on failure.
+
+    Matches the frontend's extraction, so fences, leading prose and trailing
+    citations around the object are tolerated.
+    """
+    json_match = re.search(r"\{[\s\S]*\}", content)
+    if not json_match:
+        return None
+
+    try:
+        return json.loads(json_match.group(0))
+    except json.JSONDecodeError:
+        return None
+
+
+def perplexity_headers(api_key):
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "accept": "application/json",
+        "content-type": "application/json",
+    }
+
+
+def completion_content(perplexity_data):
+    """Return the first choice's message content, or "" if the reply is malformed."""
+    try:
+        return perplexity_data["choices"][0]["message"]["content"] or ""
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
+def check_confidence(result, min_confidence):
+    try:
+        confidence = float(result.get("confidence"))
+    except (TypeError, ValueError):
+        return ["missing confidence"]
+    if confidence < min_confidence:
+        return [f"confidence {confidence:.2f} below {min_confidence:.2f}"]
+    return []
+
+
+def validate_analysis(result, min_confidence):
+    """Return a list of problems with a label analysis; empty means usable."""
+    problems = [f"missing {key}" for key in ANALYSIS_KEYS if not result.get(key)]
+
+    categories = result.get("ingredient_categories")
+    if not isinstance(categories, dict):
+        categories = {}
+    found = 0
+    for key in CATEGORY_KEYS:
+        category = categories.get(key)
+        if not isinstance(category, dict) or not isinstance(category.get("ingredients"), list):
+            problems.append(f"incomplete category {key}")
+            continue
+        ingredients = [name for name in category["ingredients"] if name and name != "None"]
+        found += len(ingredients)
+        if ingredients and not category.get("details"):
+            problems.append(f"no details for {key}")
+
+    if not found:
+        problems.append("no ingredients found")
+
+    return problems + check_confidence(result, min_confidence)
+
+
+def validate_alternatives(result, min_confidence):
+    """Return a list of problems with an alternatives result; empty means usable."""
+    problems = []
+    alternatives = result.get("alternatives")
+    if not isinstance(alternatives, list) or len(alternatives) < 3:
+        problems.append("fewer than 3 alternatives")
+    else:
+        for index, alternative in enumerate(alternatives):
+            if not isinstance(alternative, dict):
+                problems.append(f"alternative {index} is not an object")
+                continue
+            missing = [key for key in ALTERNATIVE_KEYS if not alternative.get(key)]
+            if missing:
+                problems.append(f"alternative {index} missing {', '.join(missing)}")
+
+    if not result.get("general_advice"):
+        problems.append("missing general_advice")
+
+    return problems + check_confidence(result, min_confidence)
+
+
+class ModelRouter:
+    """Sends a request to the cheapest tier first and escalates on failure.
+
+    A tier is accepted when its response parses as JSON and passes the task's
+    validator. Each attempt is logged with its latency and outcome so the tier
+    list and confidence threshold can be tuned from the logs.
+    """
+
+    def __init__(self, api_key, enabled=None, min_confidence=None):
+        self.api_key = api_key
+        if enabled is None:
+            enabled = os.environ.get("MODEL_ROUTING_ENABLED", "true").lower() == "true"
+        self.enabled = enabled
+        self.min_confidence = min_confidence or float(os.environ.get("ROUTING_MIN_CONFIDENCE", 0.7))
+
+    def complete(self, task, payload, tiers, validate):
+        """Run payload through the tiers. Returns (perplexity_data, parsed, tier)."""
+        headers = perplexity_headers(self.api_key)
+        # With routing disabled only the top tier is used, as before routing
+        tiers = tiers if self.enabled else tiers[-1:]
+        started = time.monotonic()
+        # Best parsed result from a rejected tier, served if later tiers fail
+        fallback = None
+
+        for index, tier in enumerate(tiers):
+            is_last = index == len(tiers) - 1
+            tier_payload = copy.deepcopy(payload)
+            tier_payload["model"] = tier["model"]
+            tier_payload["web_search_options"] = {"search_context_size": tier["search_context_size"]}
+
+            tier_started = time.monotonic()
+            try:
+                response = requests.post(PERPLEXITY_URL, headers=headers, json=tier_payload,
+                                         timeout=tier["timeout"])
+                response.raise_for_status()
+                perplexity_data = response.json()
+            except Exception as e:
+                latency = time.monotonic() - tier_started
+                logger.warning(f"Routing {task}: tier={tier['name']} model={tier['model']} "
+                               f"context={tier['search_context_size']} latency={latency:.2f}s "
+                               f"outcome=error error={str(e)}")
+                if not is_last:
+                    continue
+                if fallback is None:
+                    raise
+                return self.serve_fallback(task, fallback, index, started)
+            latency = time.monotonic() - tier_started
+
+            parsed = parse_json_content(completion_content(perplexity_data))
+            if isinstance(parsed, dict):
+                problems = validate(parsed, self.min_confidence)
+            else:
+                parsed = None
+                problems = ["invalid JSON"]
+
+            if not problems:
+                outcome = "accepted"
+            elif is_last:
+                outcome = "accepted_fallback"
+            else:
+                outcome = "escalate"
+
+            logger.info(f"Routing {task}: tier={tier['name']} model={tier['model']} "
+                        f"context={tier['search_context_size']} latency={latency:.2f}s "
+                        f"outcome={outcome} problems={problems}")
+
+            result = (perplexity_data, parsed, tier)
+            if outcome == "escalate":
+                if parsed is not None and (fallback is None or len(problems) < fallback[0]):
+                    fallback = (len(problems), result)
+                continue
+
+            # An earlier parsed result beats an unparseable or worse final one
+            if outcome == "accepted_fallback" and fallback is not None and (
+                parsed is None or fallback[0] < len(problems)
+            ):
+                return self.serve_fallback(task, fallback, index, started)
+
+            logger.info(f"Routing {task}: served by tier={tier['name']} after {index + 1} attempt(s), "
+                        f"total latency={time.monotonic() - started:.2f}s")
+            return result
+
+    def serve_fallback(self, task, fallback, index, started):
+        problem_count, result = fallback
+        tier = result[2]
+        logger.info(f"Routing {task}: tier={tier['name']} model={tier['model']} "
+                    f"context={tier['search_context_size']} outcome=accepted_fallback "
+                    f"problems={problem_count}")
+        logger.info(f"Routing {task}: served by tier={tier['name']} after {index + 1} attempt(s), "
+                    f"total latency={time.monotonic() - started:.2f}s")
+        return result
@@ -0,0 +1,137 @@
+import os
+import logging
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+# Collections that hold per-user data. Legacy layout keeps them at the top
+# level (filtered by user_id); the per-user layout nests them under
+# users/{uid}/<name> so reads only touch a single user's documents.
+SCANS = "scans"
+ALTERNATIVES_REQUESTS = "alternatives_requests"
+CHAT_HISTORY = "chat_history"
+USER_COLLECTIONS = (SCANS, ALTERNATIVES_REQUESTS, CHAT_HISTORY)
+
+# Collections that only exist in the per-user layout
+CHAT_SESSIONS = "chat_sessions"
+
+# Write modes: "legacy" (top-level only), "dual" (both layouts), "user"
+# (per-user subcollections only). Read modes: "legacy" or "user".
+WRITE_MODES = ("legacy", "dual", "user")
+READ_MODES = ("legacy", "user")
+
+# Firestore caps a batched write at 500 operations.
+MAX_BATCH_SIZE = 500
+
+
+class UserDataStore:
+    """Reads and writes per-user documents for either data layout.
+
+    Dual writes share a document ID across both layouts, so the bulk copy
+    can be re-run safely while the app keeps writing.
+    """
+
+    def __init__(self, db, write_mode=None, read_mode=None):
+        self.db = db
+        self.write_mode = write_mode or os.environ.get("STORAGE_WRITE_MODE", "dual")
+        self.read_mode = read_mode or os.environ.get("STORAGE_READ_MODE", "legacy")
+
+        if self.write_mode not in WRITE_MODES:
+            raise ValueError(f"Invalid storage write mode: {self.write_mode}")
+        if self.read_mode not in READ_MODES:
+            raise ValueError(f"Invalid storage read mode: {self.read_mode}")
+        if self.write_mode == "user" and self.read_mode == "legacy":
+            raise ValueError("Storage write mode 'user' requires read mode 'user'; legacy reads would miss new documents")
+
+        logger.info(f"Storage layer using write mode '{self.write_mode}', read mode '{self.read_mode}'")
+
+    def legacy_collection(self, name):
+        return self.db.collection(name)
+
+    def user_collection(self, name, user_id):
+        return self.db.collection("users").document(user_id).collection(name)
+
+    def user_document(self, name, user_id, doc_id):
+        """Reference to a document that only lives in the per-user layout."""
+        return self.user_collection(name, user_id).document(doc_id)
+
+    def add(self, name, user_id, data):
+        """Store a document for the user and return its ID."""
+        data = dict(data, user_id=user_id)
+
+        if self.write_mode == "legacy":
+            _, doc_ref = self.legacy_collection(name).add(data)
+            return doc_ref.id
+
+        if self.write_mode == "user":
+            _, doc_ref = self.user_collection(name, user_id).add(data)
+            return doc_ref.id
+
+        # Dual write: same ID in both places, committed atomically
+        doc_id = self.legacy_collection(name).document().id
+        batch = self.db.batch()
+        batch.set(self.legacy_collection(name).document(doc_id), data)
+        batch.set(self.user_collection(name, user_id).document(doc_id), data)
+        batch.commit()
+        return doc_id
+
+    def query(self, name, user_id, limit=None):
+        """Return a query for the user's documents, newest first."""
+        if self.read_mode == "user":
+            query = self.user_collection(name, user_id)
+        else:
+            query = self.legacy_collection(name).where("user_id", "==", user_id)
+
+        query = query.order_by("timestamp", direction=firestore.Query.DESCENDING)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    def copy_to_user_layout(self, name, batch_size=MAX_BATCH_SIZE, dry_run=False, start_after=None):
+        """Copy every legacy document into its owner's subcollection.
+
+        The collection is paged in document ID order, one batched write per
+        page, and the last ID of each page is logged so an interrupted copy
+        can resume with start_after. Documents keep their IDs, so copies
+        already made by dual writes are simply overwritten with identical
+        data. Returns the number copied.
+        """
+        batch_size = min(batch_size, MAX_BATCH_SIZE)
+        copied = 0
+        skipped = 0
+        cursor = start_after
+
+        while True:
+            query = self.legacy_collection(name).order_by(firestore.FieldPath.document_id()).limit(batch_size)
+            if cursor:
+                query = query.start_after({firestore.FieldPath.document_id(): cursor})
+            docs = list(query.stream())
+            if not docs:
+                break
+
+            batch = self.db.batch()
+            pending = 0
+            for doc in docs:
+                data = doc.to_dict()
+                user_id = data.get("user_id")
+                if not user_id:
+                    logger.warning(f"Skipping {name}/{doc.id}: no user_id")
+                    skipped += 1
+                    continue
+
+                copied += 1
+                if not dry_run:
+                    batch.set(self.user_collection(name, user_id).document(doc.id), data)
+                    pending += 1
+
+            if pending:
+                batch.commit()
+
+            cursor = docs[-1].id
+            logger.info(f"Processed {copied} documents from {name}, resume cursor: {cursor}")
+
+            if len(docs) < batch_size:
+                break
+
+        logger.info(f"Finished {name}: {copied} documents, {skipped} skipped")
+        return copied
@@ -302,6 +302,7 @@ export default function ChatbotScreen() {
   const router = useRouter();
   const insets = useSafeAreaInsets();
   const scrollViewRef = useRef<ScrollView>(null);
+  const sessionIdRef = useRef<string | undefined>(undefined);
   const [inputText, setInputText] = useState('');
   const [isTyping, setIsTyping] = useState(false);
   const [messages, setMessages] = useState<Message[]>([
@@ -357,7 +358,8 @@ export default function ChatbotScreen() {
     setIsTyping(true);
     
     try {
-      const response = await sendChatbotMessage(userMessage);
+      const response = await sendChatbotMessage(userMessage, undefined, sessionIdRef.current);
+      sessionIdRef.current = response.session_id;
       
       const botMessage: Message = {
         id: Date.now().toString(),
@@ -63,7 +63,7 @@ export const healthCheck = async (): Promise<boolean> => {
   }
 };
 
-export const sendChatbotMessage = async (message: string, context?: any) => {
+export const sendChatbotMessage = async (message: string, context?: any, sessionId?: string) => {
   try {
     const token = await getAuthToken();
     const user = auth.currentUser;
@@ -78,7 +78,8 @@ export const sendChatbotMessage = async (message: string, context?: any) => {
       },
       body: JSON.stringify({
         message,
-        context: context || {}
+        context: context || {},
+        session_id: sessionId
       }),
     });
     